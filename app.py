@@ -1,5 +1,9 @@
 import streamlit as st
 import google.generativeai as genai
+import asyncio
+import queue
+import threading
+import time
 
 
 # --- 0. Configure API Key securely ---
@@ -21,7 +25,7 @@ with st.sidebar:
     st.header("Model Settings")
 
     # Sliders for temperature and max_output_tokens
-    # These values will be used to configure the chat session dynamically
+    # These values are applied to each message as it is sent
     temperature = st.slider(
         "Temperature",
         min_value=0.0,
@@ -49,7 +53,7 @@ def load_gemini_model():
     """Loads the GenerativeModel once and caches it."""
     try:
         # Load the base model without generation_config here.
-        # generation_config will be applied when starting a chat session.
+        # generation_config is applied per message when it is sent.
         return genai.GenerativeModel("gemini-2.5-flash") # Or "gemini-1.5-flash", "gemini-pro"
     except Exception as e:
         st.error(f"Error loading Gemini model: {e}")
@@ -57,52 +61,84 @@ def load_gemini_model():
 
 model = load_gemini_model()
 
-# --- 4. Initialize chat history and chat session ---
-# Initialize messages list in session state if not already present
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-# Store the current model parameters in session state
-# This allows us to detect if the sliders have changed
-if "last_temperature" not in st.session_state:
-    st.session_state.last_temperature = temperature
-if "last_max_output_tokens" not in st.session_state:
-    st.session_state.last_max_output_tokens = max_output_tokens
+# --- Stream responses through the async Gemini client ---
+@st.cache_resource
+def get_event_loop():
+    """Runs one asyncio event loop in a background thread for all streaming requests."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
 
+# Streamed text is re-rendered once this many new characters arrive or this much time passes
+RENDER_MIN_CHARS = 64
+RENDER_INTERVAL_SECONDS = 0.08
 
-# Check if model parameters have changed or if chat_session needs initial setup
-if (st.session_state.last_temperature != temperature or
-    st.session_state.last_max_output_tokens != max_output_tokens or
-    "chat_session" not in st.session_state): # True on first run or after clearing session
+def stream_response(chat_session, prompt, **kwargs):
+    """Yields response text chunks while the next ones are read in the background."""
+    chunks = queue.Queue()
 
-    st.session_state.messages = [] # Clear history because parameters changed
+    async def produce():
+        try:
+            response = await chat_session.send_message_async(prompt, stream=True, **kwargs)
+            async for chunk in response:
+                chunks.put(chunk.text)
+        except Exception as e:
+            chunks.put(e) # Re-raised on the Streamlit thread
+        finally:
+            chunks.put(None) # End of stream
 
-    # Define generation and safety settings based on current slider/selectbox values
-    current_generation_config = {
-        "temperature": temperature,
-        "max_output_tokens": max_output_tokens,
-    }
+    future = asyncio.run_coroutine_threadsafe(produce(), get_event_loop())
+    try:
+        while (item := chunks.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # If the script was stopped mid-stream, stop reading so the session isn't used concurrently
+        future.cancel()
+
+def coalesce_chunks(chunks):
+    """Joins small chunks so st.write_stream re-renders the reply less often."""
+    buffer = []
+    pending_chars = 0
+    last_flush = time.monotonic()
+    try:
+        for text in chunks:
+            buffer.append(text)
+            pending_chars += len(text)
+            if pending_chars >= RENDER_MIN_CHARS or time.monotonic() - last_flush >= RENDER_INTERVAL_SECONDS:
+                yield "".join(buffer)
+                buffer.clear()
+                pending_chars = 0
+                last_flush = time.monotonic()
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        chunks.close() # Cancels the background stream if write_stream stops early
 
-    
-    # Start a new chat session with the updated parameters
-    st.session_state.chat_session = model.start_chat(
-        history=[]
-        
-        
-    )
+# --- 4. Initialize chat history and chat session ---
+# Initialize messages list in session state if not already present
+if "messages" not in st.session_state:
+    st.session_state.messages = []
 
-    # Update the stored last parameters
-    st.session_state.last_temperature = temperature
-    st.session_state.last_max_output_tokens = max_output_tokens
-   
-    # If parameters changed and caused a re-init, rerun to clear displayed chat
-    # Only rerun if it's not the very first load
-    if st.session_state.messages: # Check if messages were already present before clearing
-        st.rerun()
+# Start the chat session once; slider values are passed with each message instead,
+# so moving a slider neither restarts the session nor clears the conversation
+if "chat_session" not in st.session_state: # True on first run or after clearing session
+    st.session_state.chat_session = model.start_chat(history=[])
 
 
 # --- 5. Display chat history ---
-for msg in st.session_state.messages:
+RECENT_MESSAGES_SHOWN = 20 # Older messages are rendered together as one cached block
+
+@st.cache_data(max_entries=32)
+def render_prefix_markdown(messages_tuple):
+    """Joins older (role, content) pairs into a single Markdown block."""
+    return "\n\n".join(f"**{role.capitalize()}**: {content}" for role, content in messages_tuple)
+
+older_messages = st.session_state.messages[:-RECENT_MESSAGES_SHOWN]
+if older_messages:
+    st.markdown(render_prefix_markdown(tuple((msg["role"], msg["content"]) for msg in older_messages)))
+for msg in st.session_state.messages[-RECENT_MESSAGES_SHOWN:]:
     with st.chat_message(msg["role"]):
         st.markdown(msg["content"])
 
@@ -113,19 +149,20 @@ if user_input := st.chat_input("Type your message..."):
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    # Display a placeholder for the assistant's response (for streaming)
+    # Define generation config for this specific message
+    current_generation_config = {
+        "temperature": temperature,
+        "max_output_tokens": max_output_tokens,
+    }
+
+    # Stream the assistant's response into its chat message
     with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        full_response = ""
         try:
-            # Send message to the *persisted* chat session and stream the response
-            # The generation_config and safety_settings are already set on chat_session
-            for chunk in st.session_state.chat_session.send_message(user_input, stream=True):
-                full_response += chunk.text
-                # Update the placeholder with the streamed content and a blinking cursor
-                message_placeholder.markdown(full_response + "▌")
-            # Final display without the blinking cursor
-            message_placeholder.markdown(full_response)
+            # Send message to the *persisted* chat session and stream the response;
+            # write_stream renders it with a cursor and returns the full text
+            full_response = st.write_stream(coalesce_chunks(stream_response(
+                st.session_state.chat_session, user_input,
+                generation_config=current_generation_config)))
         except Exception as e:
             full_response = f"Error: {e}"
             st.error(full_response)
@@ -136,7 +173,6 @@ if user_input := st.chat_input("Type your message..."):
 # --- 7. Clear chat button ---
 if st.button("Clear Chat"):
     st.session_state.messages = []  # Clear message history
-    # Reset chat session to ensure it picks up current slider values
-    # By deleting chat_session, the next run will trigger the re-initialization logic above
+    # By deleting chat_session, the next run will start a fresh one above
     del st.session_state["chat_session"] 
     st.rerun() # Rerun the app to clear the displayed chat and re-initialize session
\ No newline at end of file
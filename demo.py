@@ -1,104 +1,353 @@
 import streamlit as st
 import google.generativeai as genai
+from google.generativeai import caching
 import sqlite3
-from datetime import datetime
-import json
+import asyncio
+import threading
+import queue
+import time
+import atexit
+import logging
+from datetime import datetime, timedelta, timezone
+import orjson
+import zstandard
+import hashlib
+from collections import OrderedDict
+
+try: # Optional: enables fuzzy matches in the response cache
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
 
 # --- Database Utilities ---
 DB_NAME = "chat_history.db"
 
-def init_db():
+logger = logging.getLogger(__name__)
+
+@st.cache_resource
+def get_conn():
+    """Opens one SQLite connection shared by every session and rerun, creating the schema once."""
+    # Autocommit mode: write transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL") # Lets history readers run alongside a save
+    conn.execute("PRAGMA synchronous=NORMAL") # Safe under WAL, avoids an fsync per commit
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456") # 256 MiB
+    conn.execute("PRAGMA cache_size=-20000") # ~20 MB page cache
+    init_db(conn)
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    """Serializes writers on the shared connection across Streamlit sessions."""
+    return threading.Lock()
+
+def init_db(conn):
     """Initializes the SQLite database and creates tables if they don't exist."""
-    conn = sqlite3.connect(DB_NAME)
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS chats (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            archived_blob BLOB
         )
     ''')
+    # Databases created before archiving was added lack the blob column
+    if "archived_blob" not in [row[1] for row in c.execute("PRAGMA table_info(chats)")]:
+        c.execute("ALTER TABLE chats ADD COLUMN archived_blob BLOB")
     c.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER NOT NULL,
+            ordinal INTEGER NOT NULL, -- Position of the message within its chat
             role TEXT NOT NULL,
             content TEXT NOT NULL,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (chat_id) REFERENCES chats(id) ON DELETE CASCADE
         )
     ''')
-    conn.commit()
-    conn.close()
+    # Databases created before ordinals were added number their messages in id order.
+    # One transaction, so an interrupted migration can't leave the column without its values.
+    if "ordinal" not in [row[1] for row in c.execute("PRAGMA table_info(messages)")]:
+        with conn:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("ALTER TABLE messages ADD COLUMN ordinal INTEGER NOT NULL DEFAULT 0")
+            c.execute('''
+                UPDATE messages SET ordinal = numbered.ordinal
+                FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) - 1 AS ordinal
+                      FROM messages) AS numbered
+                WHERE messages.id = numbered.id
+            ''')
+            c.execute("CREATE UNIQUE INDEX idx_messages_chat_ordinal ON messages(chat_id, ordinal)")
+    # Upsert target; also serves loading a chat in order without a scan or sort
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_ordinal ON messages(chat_id, ordinal)")
+    c.execute("DROP INDEX IF EXISTS idx_messages_chat") # Superseded by the index above
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chats_created ON chats(created_at DESC)")
+
+def _write_chat_thread(chat_id, chat_name, messages, persisted_count):
+    """Writes a chat thread to the database and returns its ID. Safe to call off the script thread."""
+    # More persisted than present means the history diverged from what was stored
+    rewrite = chat_id is not None and persisted_count > len(messages)
+    if chat_id is None:
+        persisted_count = 0 # Nothing stored yet
+
+    conn = get_conn()
+    with get_write_lock(), conn: # Commits on success, rolls back on error
+        # IMMEDIATE takes the write lock up front so the whole save is one short transaction
+        conn.execute("BEGIN IMMEDIATE")
+        c = conn.cursor()
+        if chat_id is None: # New chat
+            c.execute("INSERT INTO chats (name) VALUES (?)", (chat_name,))
+            chat_id = c.lastrowid
+        else: # Update existing chat
+            c.execute("UPDATE chats SET name = ? WHERE id = ?", (chat_name, chat_id))
+            if rewrite: # Rows past the new end are stale; the rest are overwritten below
+                c.execute("DELETE FROM messages WHERE chat_id = ? AND ordinal >= ?", (chat_id, len(messages)))
+                c.execute("UPDATE chats SET archived_blob = NULL WHERE id = ?", (chat_id,))
+                persisted_count = 0
+
+        # Upsert unsaved messages in one batched statement, keyed by their position in the chat
+        c.executemany('''
+            INSERT INTO messages (chat_id, ordinal, role, content) VALUES (?, ?, ?, ?)
+            ON CONFLICT (chat_id, ordinal) DO UPDATE SET role = excluded.role, content = excluded.content
+        ''', [(chat_id, ordinal, msg["role"], msg["content"])
+              for ordinal, msg in enumerate(messages[persisted_count:], start=persisted_count)])
+    return chat_id
+
+def chat_state_hash(chat_id, chat_name, messages):
+    """Digest of everything a save writes, used to skip saves that would change nothing."""
+    return hashlib.blake2b(orjson.dumps([chat_id, chat_name, messages]), digest_size=16).digest()
 
 def save_chat_thread(chat_id, chat_name, messages):
-    """Saves or updates a chat thread and its messages in the database."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    """Saves or updates a chat thread and its messages in the database.
 
+    Only messages added since the last save are inserted, and nothing is
+    written if the chat is unchanged since it was last saved or loaded.
+    """
     if not chat_name:
         st.error("Chat name cannot be empty for saving.")
         return None
 
-    if chat_id is None: # New chat
-        c.execute("INSERT INTO chats (name) VALUES (?)", (chat_name,))
-        new_chat_id = c.lastrowid
+    flush_pending_saves() # Queued auto-saves must land before this write
+    saved_hash = chat_state_hash(chat_id, chat_name, messages)
+    if chat_id is not None:
+        _apply_failed_saves(chat_id)
+        if get_saved_hashes().get(chat_id) == saved_hash:
+            st.toast(f"Chat '{chat_name}' is already saved.", icon="✅")
+            return chat_id
+    # Messages are append-only within a session, so anything already persisted can be skipped
+    new_chat_id = _write_chat_thread(chat_id, chat_name, messages,
+                                     st.session_state.get("persisted_message_count", 0))
+    st.session_state.persisted_message_count = len(messages)
+    get_saved_hashes()[new_chat_id] = chat_state_hash(new_chat_id, chat_name, messages)
+    get_failed_saves().pop(new_chat_id, None) # Everything the background writer missed is in now
+    get_all_chat_threads.clear() # Name or list of chats may have changed
+
+    if chat_id is None:
         st.session_state.current_chat_id = new_chat_id # Update session state with new ID
         st.toast(f"New chat '{chat_name}' saved!", icon="💾")
-    else: # Update existing chat
-        c.execute("UPDATE chats SET name = ? WHERE id = ?", (chat_name, chat_id))
-        c.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,)) # Clear old messages
-        new_chat_id = chat_id # Keep existing ID
+    else:
         st.toast(f"Chat '{chat_name}' updated!", icon="🔄")
-
-    # Insert current messages
-    for msg in messages:
-        c.execute("INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)",
-                  (new_chat_id, msg["role"], msg["content"]))
-    conn.commit()
-    conn.close()
     return new_chat_id
 
-def load_chat_thread(chat_id):
-    """Loads messages for a given chat ID from the database."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT name FROM chats WHERE id = ?", (chat_id,))
-    chat_name = c.fetchone()[0]
+# --- Deferred auto-save ---
+SAVE_DEBOUNCE_SECONDS = 2.0 # Max time a queued auto-save waits before it is written
+SAVE_BATCH_SIZE = 10 # Write early once this many auto-saves are queued
+FLUSH_TIMEOUT_SECONDS = 10.0 # Give up waiting on the background writer after this long
+
+def _save_worker(save_queue, failed_saves, saved_hashes):
+    """Drains the save queue, keeping only the newest save per chat in each batch.
+
+    When a write fails, failed_saves[chat_id] records how many messages are
+    known to be stored, so later saves of that chat start from there again.
+    Successful writes record the chat's digest in saved_hashes. Between
+    batches it also archives idle chats, ARCHIVE_BATCH_SIZE at a time.
+    """
+    next_archive = time.monotonic()
+    while True:
+        if time.monotonic() >= next_archive:
+            try:
+                archived = archive_stale_chats(ARCHIVE_BATCH_SIZE)
+            except Exception:
+                logger.exception("Archiving idle chats failed")
+                archived = 0
+            # A full batch means more may be waiting; continue right after any queued saves
+            next_archive = time.monotonic() + (0 if archived == ARCHIVE_BATCH_SIZE else ARCHIVE_INTERVAL_SECONDS)
+        try:
+            item = save_queue.get(timeout=max(0.0, next_archive - time.monotonic()))
+        except queue.Empty:
+            continue # Time to archive
+        pending = {}
+        flush_events = []
+        batched = 0
+        deadline = time.monotonic() + SAVE_DEBOUNCE_SECONDS
+        while True:
+            if isinstance(item, threading.Event): # Flush request: write what we have now
+                flush_events.append(item)
+                break
+            chat_id, chat_name, messages, persisted_count, saved_hash = item
+            if chat_id in pending: # Coalesce, but keep the oldest persisted count so no message is skipped
+                persisted_count = min(persisted_count, pending[chat_id][2])
+            pending[chat_id] = (chat_name, messages, persisted_count, saved_hash)
+            batched += 1
+            if batched >= SAVE_BATCH_SIZE: # Batch is full, write it now
+                break
+            try:
+                item = save_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+
+        for chat_id, (chat_name, messages, persisted_count, saved_hash) in pending.items():
+            # Retry whatever an earlier failed write of this chat left out
+            persisted_count = min(persisted_count, failed_saves.get(chat_id, persisted_count))
+            try:
+                _write_chat_thread(chat_id, chat_name, messages, persisted_count)
+            except Exception: # Keep the writer alive; the session retries from failed_saves
+                logger.exception("Auto-save of chat %s failed", chat_id)
+                failed_saves[chat_id] = persisted_count
+            else:
+                failed_saves.pop(chat_id, None)
+                saved_hashes[chat_id] = saved_hash
+        for event in flush_events:
+            event.set()
+
+def _flush_save_queue(save_queue):
+    done = threading.Event()
+    save_queue.put(done)
+    if not done.wait(timeout=FLUSH_TIMEOUT_SECONDS):
+        logger.warning("Timed out waiting for queued auto-saves to be written")
+
+@st.cache_resource
+def get_failed_saves():
+    """Per chat ID, how many messages are stored after a failed background write."""
+    return {}
+
+@st.cache_resource
+def get_saved_hashes():
+    """Per chat ID, the chat_state_hash of what is confirmed to be in the database."""
+    return {}
 
-    c.execute("SELECT role, content FROM messages WHERE chat_id = ? ORDER BY timestamp", (chat_id,))
-    messages = [{"role": row[0], "content": row[1]} for row in c.fetchall()]
-    conn.close()
-    return chat_name, messages
+@st.cache_resource
+def get_save_queue():
+    """Starts the background writer for auto-saves and archiving once and returns its queue."""
+    save_queue = queue.Queue()
+    threading.Thread(target=_save_worker, args=(save_queue, get_failed_saves(), get_saved_hashes()),
+                     daemon=True).start()
+    atexit.register(_flush_save_queue, save_queue) # Don't lose queued saves on shutdown
+    return save_queue
+
+def _apply_failed_saves(chat_id):
+    """Rolls the session back to what a failed background write actually stored."""
+    stored_count = get_failed_saves().get(chat_id)
+    if stored_count is not None and stored_count < st.session_state.persisted_message_count:
+        st.session_state.persisted_message_count = stored_count
+        st.toast("An auto-save failed and will be retried.", icon="⚠️")
+
+def queue_chat_save(chat_id, chat_name, messages):
+    """Schedules an auto-save of an existing chat on the background writer."""
+    _apply_failed_saves(chat_id)
+    saved_hash = chat_state_hash(chat_id, chat_name, messages)
+    if get_saved_hashes().get(chat_id) == saved_hash:
+        return # Nothing changed since the last save
+    # The writer records saved_hash once the write has actually succeeded
+    get_save_queue().put((chat_id, chat_name, list(messages),
+                          st.session_state.get("persisted_message_count", 0), saved_hash))
+    st.session_state.persisted_message_count = len(messages)
+
+def flush_pending_saves():
+    """Blocks until every queued auto-save has been written."""
+    _flush_save_queue(get_save_queue())
+
+def _read_messages(c, chat_id, archived_blob):
+    """Reads a chat's messages: the archived blob first, then any rows added since archiving."""
+    messages = orjson.loads(zstandard.decompress(archived_blob)) if archived_blob is not None else []
+    c.execute("SELECT role, content FROM messages WHERE chat_id = ? ORDER BY ordinal", (chat_id,))
+    messages.extend({"role": row[0], "content": row[1]} for row in c.fetchall())
+    return messages
 
+def load_chat_thread(chat_id):
+    """Loads messages for a given chat ID from the database."""
+    flush_pending_saves()
+    c = get_conn().cursor()
+    c.execute("SELECT name, archived_blob FROM chats WHERE id = ?", (chat_id,))
+    chat_name, archived_blob = c.fetchone()
+    return chat_name, _read_messages(c, chat_id, archived_blob)
+
+# --- Archive chats that are no longer in use ---
+ARCHIVE_AFTER_DAYS = 7
+ARCHIVE_INTERVAL_SECONDS = 24 * 3600 # How often the background writer looks for idle chats
+ARCHIVE_BATCH_SIZE = 20 # Chats archived per pass, so queued saves aren't held up for long
+
+def archive_chat(chat_id):
+    """Packs a chat's messages into one compressed blob on its chats row."""
+    conn = get_conn()
+    with get_write_lock(), conn:
+        conn.execute("BEGIN IMMEDIATE") # Read and repack atomically so no new message is lost
+        c = conn.cursor()
+        c.execute("SELECT archived_blob FROM chats WHERE id = ?", (chat_id,))
+        messages = _read_messages(c, chat_id, c.fetchone()[0])
+        c.execute("UPDATE chats SET archived_blob = ? WHERE id = ?",
+                  (zstandard.compress(orjson.dumps(messages)), chat_id))
+        c.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+
+def archive_stale_chats(limit):
+    """Archives up to limit chats whose last message is older than ARCHIVE_AFTER_DAYS.
+
+    Called from the background writer, so it never runs inside a user's rerun.
+    """
+    c = get_conn().cursor()
+    # Chats without message rows are empty or already fully archived
+    c.execute('''
+        SELECT id FROM chats
+        WHERE EXISTS (SELECT 1 FROM messages WHERE chat_id = chats.id)
+          AND (SELECT MAX(timestamp) FROM messages WHERE chat_id = chats.id) < datetime('now', ?)
+        LIMIT ?
+    ''', (f"-{ARCHIVE_AFTER_DAYS} days", limit))
+    stale_chat_ids = [row[0] for row in c.fetchall()]
+    for chat_id in stale_chat_ids:
+        archive_chat(chat_id)
+    return len(stale_chat_ids)
+
+@st.cache_data(ttl=60)
 def get_all_chat_threads():
-    """Retrieves all chat threads (ID and name) from the database."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    """Retrieves all chat threads (ID and name) from the database.
+
+    Cached across reruns; writers that change the list call get_all_chat_threads.clear().
+    """
+    c = get_conn().cursor()
     c.execute("SELECT id, name, created_at FROM chats ORDER BY created_at DESC")
-    threads = c.fetchall()
-    conn.close()
-    return threads
+    return c.fetchall()
 
 def delete_chat_thread(chat_id):
     """Deletes a chat thread and its messages from the database."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
-    # ON DELETE CASCADE on messages table will handle deleting associated messages
-    conn.commit()
-    conn.close()
+    flush_pending_saves() # Otherwise a queued save could re-insert messages after the delete
+    with get_write_lock():
+        get_conn().execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+        # ON DELETE CASCADE on messages table will handle deleting associated messages
+    get_saved_hashes().pop(chat_id, None)
+    get_all_chat_threads.clear()
     st.toast(f"Chat deleted!", icon="🗑️")
 
 # --- Helper function to convert st.session_state.messages to Gemini history format ---
 def convert_to_gemini_history(messages):
     """Converts a list of dict messages to Gemini's expected history format."""
-    gemini_history = []
-    for msg in messages:
-        # Gemini API expects 'user' and 'model' roles
-        role = "user" if msg["role"] == "user" else "model"
-        gemini_history.append({"role": role, "parts": [msg["content"]]})
-    return gemini_history
+    # Gemini API expects 'user' and 'model' roles
+    return [{"role": "user" if msg["role"] == "user" else "model", "parts": (msg["content"],)}
+            for msg in messages]
+
+def get_gemini_history(messages):
+    """Returns messages in Gemini's format, converting only those appended since the last call.
+
+    Messages are append-only within a chat; New Chat, delete and load reset the memo.
+    """
+    if st.session_state.gemini_history_len > len(messages): # Shrunk, so the memo can't be extended
+        st.session_state.gemini_history = []
+        st.session_state.gemini_history_len = 0
+    st.session_state.gemini_history.extend(
+        convert_to_gemini_history(messages[st.session_state.gemini_history_len:]))
+    st.session_state.gemini_history_len = len(messages)
+    return st.session_state.gemini_history
 
 # --- 0. Configure API Key securely ---
 try:
@@ -109,9 +358,6 @@ except Exception as e:
     st.error(f"Gemini API Key configuration failed: {e}. Please ensure it's set correctly.")
     st.stop()
 
-# --- Initialize Database ---
-init_db()
-
 # --- 1. Configure Streamlit UI ---
 st.set_page_config(page_title="Gemini Chatbot with History", page_icon="🤖", layout="wide")
 st.title("💬 Gemini Chatbot")
@@ -125,16 +371,59 @@ if "chat_name_input" not in st.session_state:
     st.session_state.chat_name_input = "" # For naming new chats or displaying current chat name
 if "chat_session" not in st.session_state:
     st.session_state.chat_session = None # Gemini chat session object
-if "last_temperature" not in st.session_state:
-    st.session_state.last_temperature = None
-if "last_max_output_tokens" not in st.session_state:
-    st.session_state.last_max_output_tokens = None
+if "gemini_history" not in st.session_state:
+    st.session_state.gemini_history = [] # Converted messages, memoized by get_gemini_history
+    st.session_state.gemini_history_len = 0
+if "persisted_message_count" not in st.session_state:
+    st.session_state.persisted_message_count = 0 # How many of the messages are already in the database
 if "loading_chat" not in st.session_state:
     st.session_state.loading_chat = False # Flag to prevent re-triggering logic when loading
 if "confirm_delete" not in st.session_state:
     st.session_state.confirm_delete = False # Flag for delete confirmation
+if "load_refused" not in st.session_state:
+    st.session_state.load_refused = False # Set when a chat load was blocked by an unsaved, unnamed chat
+
+# --- Start the background writer, which also packs idle chats into compressed archives ---
+get_save_queue()
 
 # --- Sidebar for Model Parameters and Chat Management ---
+def rename_current_chat():
+    """Takes the name from the sidebar input, saving it right away if the chat is already stored."""
+    st.session_state.chat_name_input = st.session_state.sidebar_chat_name_input
+    if st.session_state.current_chat_id is not None and st.session_state.messages:
+        save_chat_thread(st.session_state.current_chat_id,
+                         st.session_state.chat_name_input,
+                         st.session_state.messages)
+
+def load_selected_chat():
+    """Loads the chat picked in the history selectbox."""
+    selected_chat_id = st.session_state.history_select
+    if selected_chat_id is None or selected_chat_id == st.session_state.current_chat_id:
+        return
+    if st.session_state.messages and not st.session_state.current_chat_id: # Current is new, has messages
+        if not st.session_state.chat_name_input:
+            # Refuse the load; the next run resets the selectbox to the current chat
+            st.session_state.load_refused = True
+            return
+        # New chat has a name, auto-save it before loading
+        save_chat_thread(st.session_state.current_chat_id,
+                         st.session_state.chat_name_input,
+                         st.session_state.messages)
+
+    st.session_state.loading_chat = True # Set flag to prevent re-reinitialization during load
+    loaded_name, loaded_messages = load_chat_thread(selected_chat_id)
+    st.session_state.messages = loaded_messages
+    st.session_state.current_chat_id = selected_chat_id
+    st.session_state.chat_name_input = loaded_name
+    st.session_state.persisted_message_count = len(loaded_messages)
+    st.session_state.gemini_history = []
+    st.session_state.gemini_history_len = 0
+    get_saved_hashes()[selected_chat_id] = chat_state_hash(selected_chat_id, loaded_name, loaded_messages)
+    st.session_state.chat_session = None # Force re-initialization with loaded history
+    st.toast(f"Loaded chat: {loaded_name}", icon="📂")
+    st.session_state.loading_chat = False
+    st.session_state.confirm_delete = False # Reset delete confirmation
+
 with st.sidebar:
     st.header("Model Settings")
 
@@ -151,21 +440,13 @@ with st.sidebar:
 
     st.header("Chat Management")
 
-    current_chat_name = st.text_input(
+    st.text_input(
         "Current Chat Name",
         value=st.session_state.chat_name_input,
         key="sidebar_chat_name_input",
-        placeholder="Enter name for new chat"
+        placeholder="Enter name for new chat",
+        on_change=rename_current_chat, # Fires once on Enter/blur; the rerun that follows refreshes the history list
     )
-    # Update session state input if sidebar input changes
-    if current_chat_name != st.session_state.chat_name_input:
-        st.session_state.chat_name_input = current_chat_name
-        # If the user is renaming an existing chat, save it immediately
-        if st.session_state.current_chat_id is not None and st.session_state.messages:
-             save_chat_thread(st.session_state.current_chat_id,
-                              st.session_state.chat_name_input,
-                              st.session_state.messages)
-             st.rerun() # Rerun to update the history list immediately
 
     col1, col2 = st.columns(2)
     with col1:
@@ -187,6 +468,9 @@ with st.sidebar:
             st.session_state.messages = []
             st.session_state.current_chat_id = None
             st.session_state.chat_name_input = ""
+            st.session_state.persisted_message_count = 0
+            st.session_state.gemini_history = []
+            st.session_state.gemini_history_len = 0
             st.session_state.chat_session = None # Forces re-initialization
             st.session_state.confirm_delete = False # Reset delete confirmation
             st.rerun()
@@ -217,6 +501,9 @@ with st.sidebar:
                     st.session_state.messages = []
                     st.session_state.current_chat_id = None
                     st.session_state.chat_name_input = ""
+                    st.session_state.persisted_message_count = 0
+                    st.session_state.gemini_history = []
+                    st.session_state.gemini_history_len = 0
                     st.session_state.chat_session = None
                     st.session_state.confirm_delete = False # Reset flag
                     st.rerun()
@@ -229,34 +516,24 @@ with st.sidebar:
     st.subheader("Your Chat History")
     chat_threads = get_all_chat_threads()
     if chat_threads:
-        selected_chat_id = None
-        for chat_thread_id, chat_thread_name, created_at in chat_threads:
-            # Display each chat with a button to load it
-            if st.button(f"📄 {chat_thread_name} ({created_at.split(' ')[0]})", key=f"load_chat_{chat_thread_id}", use_container_width=True):
-                selected_chat_id = chat_thread_id
-
-        if selected_chat_id and selected_chat_id != st.session_state.current_chat_id:
-            # If a new chat is selected and it's different from the current one
-            if st.session_state.messages and not st.session_state.current_chat_id: # Current is new, has messages
-                 if not st.session_state.chat_name_input:
-                     st.warning("You have unsaved messages in the current chat. Please name it and save, or start a new chat (which will discard this one) before loading another.")
-                     st.stop() # Prevent loading until action is taken
-                 else: # New chat has a name, auto-save it before loading
-                     save_chat_thread(st.session_state.current_chat_id,
-                                      st.session_state.chat_name_input,
-                                      st.session_state.messages)
-
-            # Proceed with loading the selected chat
-            st.session_state.loading_chat = True # Set flag to prevent re-reinitialization during load
-            loaded_name, loaded_messages = load_chat_thread(selected_chat_id)
-            st.session_state.messages = loaded_messages
-            st.session_state.current_chat_id = selected_chat_id
-            st.session_state.chat_name_input = loaded_name
-            st.session_state.chat_session = None # Force re-initialization with loaded history
-            st.toast(f"Loaded chat: {loaded_name}", icon="📂")
-            st.session_state.loading_chat = False
-            st.session_state.confirm_delete = False # Reset delete confirmation
-            st.rerun()
+        # One selectbox instead of a button per chat keeps the sidebar to a single widget
+        chat_labels = {chat_thread_id: f"📄 {chat_thread_name} ({created_at.split(' ')[0]})"
+                       for chat_thread_id, chat_thread_name, created_at in chat_threads}
+        # Mirror the open chat; a choice the user makes is handled by load_selected_chat
+        st.session_state.history_select = (st.session_state.current_chat_id
+                                           if st.session_state.current_chat_id in chat_labels else None)
+        st.selectbox(
+            "Load chat",
+            options=list(chat_labels),
+            format_func=chat_labels.get,
+            key="history_select",
+            on_change=load_selected_chat, # Runs once per choice, before the rerun
+            placeholder="Select a saved chat",
+            label_visibility="collapsed",
+        )
+        if st.session_state.load_refused:
+            st.warning("You have unsaved messages in the current chat. Please name it and save, or start a new chat (which will discard this one) before loading another.")
+            st.session_state.load_refused = False
     else:
         st.info("No saved chats yet.")
 
@@ -272,37 +549,202 @@ def load_gemini_model():
 
 model = load_gemini_model()
 
-# --- 4. Initialize or re-initialize chat session based on parameters/history ---
-# Check if model parameters have changed or if chat_session needs initial setup
-# Also re-initialize if a chat was loaded from history
-if (st.session_state.last_temperature != temperature or
-    st.session_state.last_max_output_tokens != max_output_tokens or
-    st.session_state.chat_session is None): # chat_session is None implies new/reloaded chat
-
-    # Only clear messages if parameters truly changed, and not when loading a chat
-    if (st.session_state.last_temperature is not None and
-        st.session_state.last_max_output_tokens is not None and
-        (st.session_state.last_temperature != temperature or
-         st.session_state.last_max_output_tokens != max_output_tokens) and
-        not st.session_state.loading_chat): # Don't clear if currently loading a chat
-        st.session_state.messages = [] # Clear history if parameters changed
-
-    # Convert current messages to Gemini history format
-    initial_history = convert_to_gemini_history(st.session_state.messages)
-
-    # Start a new chat session with the updated parameters and potentially loaded history
-    st.session_state.chat_session = model.start_chat(
-        history=initial_history,
-        # safety_settings={...} can be added here if needed to apply to the whole session
-    )
+# --- Stream responses through the async Gemini client ---
+@st.cache_resource
+def get_event_loop():
+    """Runs one asyncio event loop in a background thread for all streaming requests."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Streamed text is re-rendered once this many new characters arrive or this much time passes
+RENDER_MIN_CHARS = 64
+RENDER_INTERVAL_SECONDS = 0.08
+
+def stream_response(chat_session, prompt, **kwargs):
+    """Yields response text chunks while the next ones are read in the background."""
+    chunks = queue.Queue()
+
+    async def produce():
+        try:
+            response = await chat_session.send_message_async(prompt, stream=True, **kwargs)
+            async for chunk in response:
+                chunks.put(chunk.text)
+        except Exception as e:
+            chunks.put(e) # Re-raised on the Streamlit thread
+        finally:
+            chunks.put(None) # End of stream
 
-    # Update the stored last parameters
-    st.session_state.last_temperature = temperature
-    st.session_state.last_max_output_tokens = max_output_tokens
+    future = asyncio.run_coroutine_threadsafe(produce(), get_event_loop())
+    try:
+        while (item := chunks.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # If the script was stopped mid-stream, stop reading so the session isn't used concurrently
+        future.cancel()
+
+def coalesce_chunks(chunks):
+    """Joins small chunks so st.write_stream re-renders the reply less often."""
+    buffer = []
+    pending_chars = 0
+    last_flush = time.monotonic()
+    try:
+        for text in chunks:
+            buffer.append(text)
+            pending_chars += len(text)
+            if pending_chars >= RENDER_MIN_CHARS or time.monotonic() - last_flush >= RENDER_INTERVAL_SECONDS:
+                yield "".join(buffer)
+                buffer.clear()
+                pending_chars = 0
+                last_flush = time.monotonic()
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        chunks.close() # Cancels the background stream if write_stream stops early
+
+# --- Serve long histories from a Gemini context cache ---
+CACHE_MIN_TOKENS = 2048 # Smallest history Gemini accepts for explicit caching
+CACHE_TTL = timedelta(minutes=10)
+CACHE_REFRESH_TURNS = 10 # Re-cache after this many new exchanges
+
+def drop_cache():
+    """Deletes the session's current context cache, if any, so it stops being billed."""
+    if st.session_state.get("cache_name"):
+        try:
+            caching.CachedContent.get(st.session_state.cache_name).delete()
+        except Exception:
+            pass # It may already have expired
+    st.session_state.cache_name = None
+
+def ensure_cache(history):
+    """Caches the history on Gemini's side if it is long enough; returns the cache or None."""
+    if model.count_tokens(history).total_tokens < CACHE_MIN_TOKENS:
+        return None
+    cache = caching.CachedContent.create(model=model.model_name, contents=history, ttl=CACHE_TTL)
+    drop_cache() # Drop the cache this one replaces
+    st.session_state.cache_name = cache.name
+    st.session_state.cache_expire_time = cache.expire_time
+    return cache
+
+def cache_expired():
+    """True if the current chat session relies on a context cache that is about to expire."""
+    if not st.session_state.get("cache_name"):
+        return False
+    return datetime.now(timezone.utc) >= st.session_state.cache_expire_time - timedelta(seconds=30)
+
+def start_chat_session(messages):
+    """Starts a chat session, sending only new turns when the history is cached."""
+    history = get_gemini_history(messages)
+    st.session_state.cache_checked_count = len(messages)
+    cache = None
+    if history:
+        try:
+            cache = ensure_cache(history)
+        except Exception as e: # Caching is only an optimization, fall back to sending the history
+            st.toast(f"Context caching unavailable: {e}", icon="⚠️")
+    if cache is None:
+        drop_cache() # The previous chat's cache is no longer used
+        return model.start_chat(history=history)
+    return genai.GenerativeModel.from_cached_content(cached_content=cache).start_chat(history=[])
+
+def refresh_cache_before_send(messages):
+    """Moves the chat session onto a fresh context cache when one is due.
+
+    Called only when a message is about to be sent, so opening a chat or moving a
+    slider never counts tokens or creates a billed cache.
+    """
+    checked = st.session_state.cache_checked_count
+    if checked is not None and not cache_expired() and len(messages) - checked < 2 * CACHE_REFRESH_TURNS:
+        return
+    st.session_state.chat_session = start_chat_session(messages)
+
+# --- Reuse replies to prompts that were already answered ---
+RESPONSE_CACHE_TTL_SECONDS = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+SEMANTIC_MATCH_THRESHOLD = 0.95 # Cosine similarity above which two prompts count as the same question
+
+@st.cache_resource
+def get_response_cache():
+    """Process-wide LRU of replies, shared by all sessions, plus the lock guarding it."""
+    return OrderedDict(), threading.Lock()
+
+@st.cache_resource
+def load_embedding_model():
+    """Loads the sentence embedding model used for fuzzy cache hits, if it is installed."""
+    if SentenceTransformer is None:
+        return None
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+def embed_prompt(prompt):
+    """Returns the prompt's normalized embedding, or None without sentence-transformers."""
+    embedding_model = load_embedding_model()
+    if embedding_model is None:
+        return None
+    return embedding_model.encode(prompt, normalize_embeddings=True)
+
+def response_cache_key(prompt, messages, generation_config):
+    """Cache key for a prompt sent after the given messages with the given settings."""
+    history_hash = hashlib.blake2b(orjson.dumps(messages), digest_size=16).digest()
+    return (prompt, history_hash, generation_config["temperature"], generation_config["max_output_tokens"])
+
+def lookup_cached_response(key):
+    """Returns a cached reply for the key, or for a near-identical prompt in the same context."""
+    cache, lock = get_response_cache()
+    now = time.monotonic()
+    with lock:
+        for stale_key in [k for k, entry in cache.items() if now - entry["stored_at"] > RESPONSE_CACHE_TTL_SECONDS]:
+            del cache[stale_key]
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]["response"]
+        candidates = [(k, entry) for k, entry in cache.items()
+                      if k[1:] == key[1:] and entry["embedding"] is not None]
+    if not candidates:
+        return None
+    embedding = embed_prompt(key[0])
+    if embedding is None:
+        return None
+    best_key, best_entry = max(candidates, key=lambda item: float(item[1]["embedding"] @ embedding))
+    if float(best_entry["embedding"] @ embedding) < SEMANTIC_MATCH_THRESHOLD:
+        return None
+    with lock:
+        if best_key in cache:
+            cache.move_to_end(best_key)
+    return best_entry["response"]
+
+def store_cached_response(key, response):
+    """Remembers a reply, evicting the least recently used ones past the size limit."""
+    cache, lock = get_response_cache()
+    entry = {"response": response, "embedding": embed_prompt(key[0]), "stored_at": time.monotonic()}
+    with lock:
+        cache[key] = entry
+        cache.move_to_end(key)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+# --- 4. Initialize or re-initialize chat session based on history ---
+# Slider values are passed with each message, so only a new/reloaded chat needs a fresh session
+if st.session_state.chat_session is None: # None implies new/reloaded chat
+    drop_cache() # A cache built for the previous chat no longer applies
+    # Start a new chat session with the potentially loaded history
+    st.session_state.chat_session = model.start_chat(history=get_gemini_history(st.session_state.messages))
+    st.session_state.cache_checked_count = None # Context caching is decided when the first message is sent
     # No need to rerun here, as the display logic will pick up new messages
 
 # --- 5. Display chat history ---
-for msg in st.session_state.messages:
+RECENT_MESSAGES_SHOWN = 20 # Older messages are rendered together as one cached block
+
+@st.cache_data(max_entries=32)
+def render_prefix_markdown(messages_tuple):
+    """Joins older (role, content) pairs into a single Markdown block."""
+    return "\n\n".join(f"**{role.capitalize()}**: {content}" for role, content in messages_tuple)
+
+older_messages = st.session_state.messages[:-RECENT_MESSAGES_SHOWN]
+if older_messages:
+    st.markdown(render_prefix_markdown(tuple((msg["role"], msg["content"]) for msg in older_messages)))
+for msg in st.session_state.messages[-RECENT_MESSAGES_SHOWN:]:
     with st.chat_message(msg["role"]):
         st.markdown(msg["content"])
 
@@ -322,33 +764,46 @@ if user_input := st.chat_input("Type your message...", disabled=input_disabled):
         "max_output_tokens": max_output_tokens,
     }
 
-    # Display a placeholder for the assistant's response (for streaming)
+    # Stream the assistant's response into its chat message
     with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        full_response = ""
-        try:
-            # Send message to the *persisted* chat session and stream the response
-            # Pass generation_config and safety_settings here!
-            for chunk in st.session_state.chat_session.send_message(
-                user_input,
-                stream=True,
-                generation_config=current_generation_config,
-                # safety_settings={...} can be added here if needed for this specific message
-            ):
-                full_response += chunk.text
-                message_placeholder.markdown(full_response + "▌")
-            message_placeholder.markdown(full_response)
-        except Exception as e:
-            full_response = f"Error: {e}"
-            st.error(full_response)
+        cache_key = response_cache_key(user_input, st.session_state.messages[:-1], current_generation_config)
+        full_response = lookup_cached_response(cache_key)
+        if full_response is not None:
+            st.markdown(full_response)
+            # Keep the Gemini session in step, as if the reply had just been generated
+            st.session_state.chat_session.history = (
+                st.session_state.chat_session.history
+                + convert_to_gemini_history([{"role": "user", "content": user_input},
+                                             {"role": "assistant", "content": full_response}]))
+        else:
+            try:
+                # Build or refresh the context cache for the history before this message
+                refresh_cache_before_send(st.session_state.messages[:-1])
+                # Send message to the *persisted* chat session and stream the response
+                # Pass generation_config and safety_settings here!
+                full_response = st.write_stream(coalesce_chunks(stream_response(
+                    st.session_state.chat_session,
+                    user_input,
+                    generation_config=current_generation_config,
+                    # safety_settings={...} can be added here if needed for this specific message
+                )))
+                store_cached_response(cache_key, full_response)
+            except Exception as e:
+                full_response = f"Error: {e}"
+                st.error(full_response)
 
         # Append assistant's full response to chat history
         st.session_state.messages.append({"role": "assistant", "content": full_response})
 
         # Auto-save/update current chat after a new message exchange
         if st.session_state.chat_name_input: # Only auto-save if a name is provided
-            save_chat_thread(st.session_state.current_chat_id,
-                             st.session_state.chat_name_input,
-                             st.session_state.messages)
+            if st.session_state.current_chat_id is None: # First save assigns the chat ID, so do it now
+                save_chat_thread(None,
+                                 st.session_state.chat_name_input,
+                                 st.session_state.messages)
+            else: # Existing chats are written in the background so the reply isn't held up
+                queue_chat_save(st.session_state.current_chat_id,
+                                st.session_state.chat_name_input,
+                                st.session_state.messages)
         elif not st.session_state.chat_name_input and st.session_state.messages:
             st.info("💡 Enter a chat name in the sidebar to automatically save your conversation progress!")
\ No newline at end of file